@@ -1,36 +1,43 @@
 import asyncio
 import random
+import time
 
 import discord
 from discord import DMChannel, Emoji, Intents, PartialEmoji
 from discord.ext import commands
 
 from bot.constants import ALPHANUMERIC_TO_EMOJI_MAP
+from bot.profiling import BotProfiler
 from chat_ai.chatai_handler import (
     ChannelMemoryItem,
     ChatAIException,
     ChatAIHandler,
     Role,
 )
+from config import AIParametersConfig, ConfigReloader
 
 EmojiInputType = Emoji | PartialEmoji | str
 
-REPLY_CHANCE = 0.01
-EMOJI_REPLY_CHANCE = 0.005
-
 
 class ChatBot(commands.Bot):
     def __init__(
         self,
         chat_ai: ChatAIHandler,
         reaction_ai: ChatAIHandler,
+        ai_parameters: AIParametersConfig,
         intents: Intents,
         guild_id: str | None = None,
+        config_reloader: ConfigReloader | None = None,
         debug: bool = False,
     ) -> None:
         self._chat_ai = chat_ai
         self._debug = debug
         self._reaction_ai = reaction_ai
+        self._ai_parameters = ai_parameters
+        self._config_reloader = config_reloader
+        self._profiler = BotProfiler(
+            handlers={"chat": chat_ai, "reactions": reaction_ai}
+        )
         self._guild_id = discord.Object(id=str(guild_id)) if guild_id else None
 
         self._emojis_enabled = True
@@ -38,6 +45,10 @@ class ChatBot(commands.Bot):
         super().__init__(intents=intents, command_prefix="!")
 
     async def setup_hook(self):
+        self._profiler.start()
+        if self._config_reloader:
+            await self._config_reloader.start()
+
         try:
             synced = await self.tree.sync()
             print(f"Synced {len(synced)} commands.")
@@ -50,12 +61,62 @@ class ChatBot(commands.Bot):
     def clear_history(self) -> None:
         self._chat_ai.clear_history(clear_all_channels=True)
 
-    def set_system_prompt(self, text: str) -> None:
-        self._chat_ai.set_system_prompt(text=text)
+    def set_system_prompt(
+        self,
+        text: str,
+        guild_id: int | None = None,
+        channel_id: int | None = None,
+    ) -> None:
+        self._chat_ai.set_system_prompt(
+            text=text,
+            guild_id=str(guild_id) if guild_id else None,
+            channel_id=str(channel_id) if channel_id else None,
+        )
+
+    def reset_system_prompt(
+        self, guild_id: int | None = None, channel_id: int | None = None
+    ) -> None:
+        self._chat_ai.reset_system_prompt(
+            guild_id=str(guild_id) if guild_id else None,
+            channel_id=str(channel_id) if channel_id else None,
+        )
 
     def set_emojis_enabled(self, enabled: bool) -> None:
         self._emojis_enabled = enabled
 
+    @property
+    def profiler(self) -> BotProfiler:
+        return self._profiler
+
+    def set_ai_parameters(self, ai_parameters: AIParametersConfig) -> None:
+        self._ai_parameters = ai_parameters
+
+    def get_usage_summary(self, window_hours: int = 24, limit: int = 5) -> str:
+        usage = self._chat_ai.usage
+        window_seconds = min(window_hours * 3600, usage.retention_seconds)
+
+        lines = [f"**Top token consumers (last {window_seconds // 3600}h)**"]
+        for title, top, format_name in (
+            ("Servers", usage.top_guilds, self._format_guild_name),
+            ("Channels", usage.top_channels, lambda id: f"<#{id}>"),
+        ):
+            lines.append(f"__{title}__")
+            consumers = top(window_seconds, limit)
+            if not consumers:
+                lines.append("nothing yet")
+            for id, counts in consumers:
+                lines.append(
+                    f"{format_name(id)}: {counts.total_tokens} tokens "
+                    f"({counts.prompt_tokens} prompt, {counts.cached_tokens} cached, "
+                    f"{counts.completion_tokens} completion) over {counts.requests} requests"
+                )
+
+        return "\n".join(lines)
+
+    def _format_guild_name(self, guild_id: str) -> str:
+        guild = self.get_guild(int(guild_id))
+        return guild.name if guild else guild_id
+
     @property
     def _at_code(self) -> str:
         if not self.user:
@@ -68,7 +129,9 @@ class ChatBot(commands.Bot):
         channel_id = message.channel.id
         input_text = f"||{','.join(emojis.keys())}||{message.content}"
         reaction = await self._reaction_ai.get_response(
-            channel_id=str(channel_id), message_text=input_text
+            channel_id=str(channel_id),
+            message_text=input_text,
+            guild_id=str(message.guild.id) if message.guild else None,
         )
 
         if reaction in emojis:
@@ -99,7 +162,9 @@ class ChatBot(commands.Bot):
 
         if memory_items:
             self._chat_ai.initialise_channel_history(
-                channel_id=str(channel.id), messages=memory_items
+                channel_id=str(channel.id),
+                messages=memory_items,
+                guild_id=str(channel.guild.id) if channel.guild else None,
             )
 
     # TODO: make this a generic reuseable thing for any server
@@ -220,11 +285,28 @@ class ChatBot(commands.Bot):
             await self._chat_ai.get_response(
                 channel_id=str(channel.id),
                 message_text="I'm lonely",
+                guild_id=str(channel.guild.id) if channel.guild else None,
             )
 
     async def on_message(self, message: discord.Message) -> None:
+        start = time.perf_counter()
+        try:
+            await self._handle_message(message)
+        finally:
+            self._profiler.record_message(
+                duration=time.perf_counter() - start,
+                channel_id=str(message.channel.id),
+                message_id=message.id,
+            )
+
+    async def _handle_message(self, message: discord.Message) -> None:
+        ai_parameters = self._ai_parameters
+        channel_id = str(message.channel.id)
+        guild_id = str(message.guild.id) if message.guild else None
         if self._chat_ai._bot_name.lower() in message.content.lower() or (
-            random.random() <= float(EMOJI_REPLY_CHANCE) and self._emojis_enabled
+            random.random() <= ai_parameters.emoji_reply_chance
+            and self._emojis_enabled
+            and not self._reaction_ai.is_over_budget(channel_id, guild_id)
         ):
             await self._react_to_message(message)
 
@@ -246,25 +328,31 @@ class ChatBot(commands.Bot):
             if str(mention) == username:
                 has_mentioned = True
 
+        # Channels over their token budget get a cheaper reply and no random ones
+        over_budget = self._chat_ai.is_over_budget(channel_id, guild_id)
         if (
             isinstance(message.channel, DMChannel)
             or has_mentioned
-            or random.random() <= float(REPLY_CHANCE)
+            or (not over_budget and random.random() <= ai_parameters.reply_chance)
         ):
             async with message.channel.typing():
                 try:
                     ai_response = await self._chat_ai.get_response(
-                        channel_id=str(message.channel.id),
+                        channel_id=channel_id,
                         message_text=msg_text,
                         reply_to_username=message.author.name,
+                        guild_id=guild_id,
+                        downgrade=over_budget,
                     )
 
+                    reply_to = None
                     if has_mentioned:
                         reply_to = await message.channel.fetch_message(message.id)
-                        await message.channel.send(ai_response, reference=reply_to)
-                        return
 
-                    await message.channel.send(ai_response)
+                    for i, chunk in enumerate(self._chat_ai.split_message(ai_response)):
+                        await message.channel.send(
+                            chunk, reference=reply_to if i == 0 else None
+                        )
                 except ChatAIException as e:
                     await message.channel.send(
                         f"😰 {username} broke and couldn't respond (error: {e})"
@@ -0,0 +1,262 @@
+import asyncio
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from types import FrameType
+
+from chat_ai.chatai_handler import ChatAIHandler
+
+CPU_SAMPLE_INTERVAL = 0.005
+LOOP_LAG_INTERVAL = 0.5
+MAX_PROFILE_SECONDS = 300
+# The event loop waits for IO in here, so samples ending in it mean the loop was idle
+IDLE_FRAME_FILENAME = "selectors.py"
+
+
+@dataclass
+class MessageTiming:
+    duration: float
+    channel_id: str
+    message_id: int
+    timestamp: float
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread (the event loop) from a background thread.
+
+    Unlike cProfile this doesn't hook every call, so it's cheap enough to run against the
+    live bot.
+    """
+
+    def __init__(self, thread_id: int, interval: float = CPU_SAMPLE_INTERVAL):
+        self._thread_id = thread_id
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.stacks: Counter[tuple[str, ...]] = Counter()
+        self.samples = 0
+        self.idle_samples = 0
+        self._idle_stacks: set[tuple[str, ...]] = set()
+
+    @staticmethod
+    def _format_frame(frame: FrameType) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})"
+
+    def _run(self) -> None:
+        while not self._stop.wait(self._interval):
+            frame = sys._current_frames().get(self._thread_id)
+            is_idle = bool(
+                frame and Path(frame.f_code.co_filename).name == IDLE_FRAME_FILENAME
+            )
+            stack = []
+            while frame:
+                stack.append(self._format_frame(frame))
+                frame = frame.f_back
+
+            stack = tuple(reversed(stack))
+            self.stacks[stack] += 1
+            self.samples += 1
+            if is_idle:
+                self.idle_samples += 1
+                self._idle_stacks.add(stack)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def top_functions(self, limit: int = 10) -> list[tuple[str, int]]:
+        """Functions that were at the top of the stack most often, ignoring idle time"""
+        leaves: Counter[str] = Counter()
+        for stack, count in self.stacks.items():
+            if stack and stack not in self._idle_stacks:
+                leaves[stack[-1]] += count
+        return leaves.most_common(limit)
+
+    def write_collapsed(self, path: Path) -> None:
+        """Write the samples in the collapsed stack format used by flamegraph tools"""
+        with path.open("w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+
+
+class BotProfiler:
+    """Collects event loop lag and message timings, and runs profiles on demand"""
+
+    def __init__(
+        self, handlers: dict[str, ChatAIHandler], output_dir: Path = Path("profiles")
+    ):
+        # Keyed by a label for the handler, which is shown alongside its channels
+        self._handlers = handlers
+        self._output_dir = output_dir
+        self._loop_lags: deque[float] = deque(maxlen=600)
+        self._message_timings: deque[MessageTiming] = deque(maxlen=500)
+        self._lag_task: asyncio.Task | None = None
+        self._cpu_profile_running = False
+
+    def start(self) -> None:
+        if not self._lag_task:
+            self._lag_task = asyncio.get_running_loop().create_task(
+                self._monitor_loop_lag()
+            )
+
+    async def _monitor_loop_lag(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self._loop_lags.append(max(loop.time() - start - LOOP_LAG_INTERVAL, 0))
+
+    def record_message(self, duration: float, channel_id: str, message_id: int) -> None:
+        self._message_timings.append(
+            MessageTiming(
+                duration=duration,
+                channel_id=channel_id,
+                message_id=message_id,
+                timestamp=time.time(),
+            )
+        )
+
+    def _output_path(self, kind: str, suffix: str) -> Path:
+        self._output_dir.mkdir(parents=True, exist_ok=True)
+        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        return self._output_dir / f"{kind}-{timestamp}.{suffix}"
+
+    async def profile_cpu(self, seconds: int) -> str:
+        if self._cpu_profile_running:
+            return "A CPU profile is already running"
+
+        seconds = min(max(seconds, 1), MAX_PROFILE_SECONDS)
+        profiler = SamplingProfiler(thread_id=threading.get_ident())
+        self._cpu_profile_running = True
+        try:
+            profiler.start()
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.stop()
+            self._cpu_profile_running = False
+
+        path = self._output_path("cpu", "collapsed")
+        await asyncio.to_thread(profiler.write_collapsed, path)
+
+        idle_percent = (
+            profiler.idle_samples / profiler.samples * 100 if profiler.samples else 0
+        )
+        lines = [
+            f"**CPU profile** ({seconds}s, {profiler.samples} samples, "
+            f"{idle_percent:.1f}% idle) → `{path}`"
+        ]
+        for function, count in profiler.top_functions(limit=8):
+            percent = count / profiler.samples * 100 if profiler.samples else 0
+            lines.append(f"`{percent:5.1f}%` {function}")
+        return "\n".join(lines)
+
+    async def profile_memory(self, stop: bool = False) -> str:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            return "Started tracing memory allocations, run this again to take a snapshot"
+
+        # Snapshotting a big heap is slow, so keep it off the event loop. Only the
+        # channel sizes need to be read here since they touch the handlers' state.
+        channel_sizes = {
+            name: handler.channel_memory_sizes()
+            for name, handler in self._handlers.items()
+        }
+        return await asyncio.to_thread(self._snapshot_memory, channel_sizes, stop)
+
+    def _snapshot_memory(
+        self, channel_sizes: dict[str, list[tuple[str, int, int]]], stop: bool
+    ) -> str:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if stop:
+            tracemalloc.stop()
+
+        stats = snapshot.statistics("lineno")
+        channel_sizes = {
+            name: sorted(sizes, key=lambda item: item[2], reverse=True)
+            for name, sizes in channel_sizes.items()
+        }
+
+        path = self._output_path("memory", "txt")
+        with path.open("w") as f:
+            f.write(f"traced: {current} bytes (peak {peak} bytes)\n\n")
+            f.write("top allocators:\n")
+            for stat in stats[:50]:
+                f.write(f"{stat}\n")
+            f.write("\nchannel memory (handler, channel id, messages, bytes):\n")
+            for name, sizes in channel_sizes.items():
+                for channel_id, num_messages, size in sizes:
+                    f.write(f"{name} {channel_id} {num_messages} {size}\n")
+
+        lines = [
+            f"**Memory** traced {current / 1024:.0f} KiB (peak {peak / 1024:.0f} KiB) → `{path}`"
+        ]
+        for stat in stats[:5]:
+            frame = stat.traceback[0]
+            lines.append(
+                f"`{stat.size / 1024:8.1f} KiB` {Path(frame.filename).name}:{frame.lineno}"
+            )
+        for name, sizes in channel_sizes.items():
+            lines.append(
+                f"**{name}**: {len(sizes)} channel memories, "
+                f"{sum(size for _, _, size in sizes) / 1024:.1f} KiB of messages"
+            )
+            for channel_id, num_messages, size in sizes[:3]:
+                lines.append(
+                    f"<#{channel_id}>: {num_messages} messages, {size / 1024:.1f} KiB"
+                )
+        if stop:
+            lines.append("Stopped tracing memory allocations")
+        return "\n".join(lines)
+
+    def _write_status(
+        self, path: Path, lags: list[float], timings: list[MessageTiming]
+    ) -> None:
+        with path.open("w") as f:
+            f.write("event loop lag samples (seconds):\n")
+            f.write(" ".join(f"{lag:.4f}" for lag in lags) + "\n\n")
+            f.write("on_message timings (duration, channel id, message id, timestamp):\n")
+            for timing in timings:
+                f.write(
+                    f"{timing.duration:.4f} {timing.channel_id} "
+                    f"{timing.message_id} {timing.timestamp:.0f}\n"
+                )
+
+    async def status(self, limit: int = 5) -> str:
+        lags = list(self._loop_lags)
+        timings = list(self._message_timings)
+        slowest = sorted(timings, key=lambda timing: timing.duration, reverse=True)[
+            :limit
+        ]
+
+        path = self._output_path("status", "txt")
+        await asyncio.to_thread(self._write_status, path, lags, timings)
+
+        lines = [f"**Status** → `{path}`"]
+        if lags:
+            lines.append(
+                f"Event loop lag: avg {sum(lags) / len(lags) * 1000:.1f}ms, "
+                f"max {max(lags) * 1000:.1f}ms over the last {len(lags)} checks"
+            )
+        else:
+            lines.append("Event loop lag: no samples yet")
+
+        lines.append("Slowest recent on_message calls:")
+        for timing in slowest:
+            lines.append(
+                f"`{timing.duration * 1000:8.0f}ms` <#{timing.channel_id}> "
+                f"<t:{timing.timestamp:.0f}:R>"
+            )
+        if not slowest:
+            lines.append("none yet")
+        return "\n".join(lines)
@@ -1,8 +1,9 @@
 import enum
-import re
-from dataclasses import asdict, dataclass
+import sys
+from dataclasses import asdict, dataclass, field
 
 from openai import AsyncOpenAI
+from openai.types import CompletionUsage
 from openai.types.chat import (
     ChatCompletionAssistantMessageParam,
     ChatCompletionContentPartTextParam,
@@ -11,7 +12,9 @@ from openai.types.chat import (
     ChatCompletionUserMessageParam,
 )
 
-from config import AIParametersConfig
+from chat_ai.postprocessing import PostProcessor
+from chat_ai.usage import UsageTracker
+from config import AIParametersConfig, PostProcessingConfig, UsageBudgetConfig
 
 
 class ChatAIException(Exception):
@@ -47,70 +50,148 @@ class ChannelMemoryItem:
         )
 
 
+@dataclass
+class PromptProfile:
+    """
+    A set of system prompts shared by reference between every channel it applies to.
+
+    The OpenAI payload for the prompts is serialised once when the prompts change rather
+    than on every request, so updating a profile is picked up by all channels using it.
+    """
+
+    system_prompts: list[ChannelMemoryItem]
+    payload: list[ChatCompletionMessageParam] = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.set_system_prompts(self.system_prompts)
+
+    @classmethod
+    def from_text(cls, text: str) -> "PromptProfile":
+        return cls(
+            system_prompts=[
+                ChannelMemoryItem(role=Role.system, username=None, text=text)
+            ]
+        )
+
+    def set_system_prompts(self, system_prompts: list[ChannelMemoryItem]) -> None:
+        self.system_prompts = system_prompts
+        self.payload = [sp.to_openai_type() for sp in system_prompts]
+
+    def set_text(self, text: str) -> None:
+        self.set_system_prompts(
+            [ChannelMemoryItem(role=Role.system, username=None, text=text)]
+        )
+
+
+@dataclass
+class ChatAIResponse:
+    text: str
+    model: str
+    usage: CompletionUsage | None = None
+
+
 class ChannelMemory:
     channel_id: str
+    guild_id: str | None
     max_length: int
 
-    system_prompts: list[ChannelMemoryItem]
+    prompt_profile: PromptProfile
     _messages: list[ChannelMemoryItem]
 
     def __init__(
         self,
         bot_name: str,
         channel_id: str,
-        system_prompts: list[ChannelMemoryItem],
+        prompt_profile: PromptProfile,
         messages: list[ChannelMemoryItem] | None = None,
         max_length: int = 50,
+        guild_id: str | None = None,
     ):
         self.bot_name = bot_name
         self.channel_id = channel_id
+        self.guild_id = guild_id
         self.max_length = max_length
-        self.system_prompts = system_prompts
+        self.prompt_profile = prompt_profile
         self._messages = messages or []
 
+    @property
+    def system_prompts(self) -> list[ChannelMemoryItem]:
+        return self.prompt_profile.system_prompts
+
     def append_message(self, message: ChannelMemoryItem) -> None:
         self._messages.append(message)
-        if len(self._messages) > self.max_length:
-            self._messages = self._messages[-self.max_length :]
+        # A max_length of 0 still keeps the latest message since it's the one being
+        # replied to (and `[-0:]` would keep everything)
+        max_length = max(self.max_length, 1)
+        if len(self._messages) > max_length:
+            self._messages = self._messages[-max_length:]
 
     @property
     def messages(self) -> list[ChannelMemoryItem]:
         return self.system_prompts + self._messages
 
     def export_as_openai_type(
-        self, condense: bool = False
+        self, condense: bool = False, max_messages: int | None = None
     ) -> list[ChatCompletionMessageParam]:
         """
         Export the channel memory as a list of OpenAI chat completion message parameters.
 
         Args:
             condense (bool): Whether to condense the messages into a single message.
+            max_messages (int | None): Only export this many of the most recent messages.
 
         Returns:
             list[ChatCompletionMessageParam]: The channel memory as a list of OpenAI chat completion message parameters.
         """
+        messages = self._messages
+        if max_messages is not None:
+            # Always keep the latest message, it's the one being replied to
+            messages = messages[-max(max_messages, 1) :]
+
         if not condense:
-            return [item.to_openai_type() for item in self.messages]
+            return self.prompt_profile.payload + [
+                item.to_openai_type() for item in messages
+            ]
 
         user_messages: list[str] = []
-        for message in self._messages:
+        for message in messages:
             if message.username:
                 user_messages.append(f"{message.username}: {message.text}")
             user_messages.append(message.text)
 
         compiled_message = "\n".join(user_messages) + f"\n{self.bot_name}"
-        return [sp.to_openai_type() for sp in self.system_prompts] + [
+        return self.prompt_profile.payload + [
             {"role": "user", "content": compiled_message}
         ]
 
     def clear(self) -> None:
         self._messages = []
 
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    @property
+    def approximate_size(self) -> int:
+        """Rough number of bytes used by the messages (not counting the shared prompts)"""
+        return sum(
+            sys.getsizeof(message)
+            + sys.getsizeof(message.text)
+            + sys.getsizeof(message.username)
+            for message in self._messages
+        )
+
 
 class ChatAIHandler:
     _conversation_history: dict[str, ChannelMemory]
-    _primary_system_prompts: list[ChannelMemoryItem]
+    _guild_channels: dict[str, set[str]]
+    _default_prompt_profile: PromptProfile
+    _guild_prompt_profiles: dict[str, PromptProfile]
+    _channel_prompt_profiles: dict[str, PromptProfile]
+    _configured_guild_prompts: set[str]
+    _configured_channel_prompts: set[str]
     _ai_parameters: AIParametersConfig
+    _usage_budget: UsageBudgetConfig | None
+    _post_processor: PostProcessor
 
     def __init__(
         self,
@@ -119,6 +200,10 @@ class ChatAIHandler:
         chat_history_length: int,
         ai_parameters: AIParametersConfig,
         initial_prompt: str | None = None,
+        client: AsyncOpenAI | None = None,
+        usage_budget: UsageBudgetConfig | None = None,
+        usage_tracker: UsageTracker | None = None,
+        post_processing: PostProcessingConfig | None = None,
         debug: bool = False,
     ):
         if not initial_prompt:
@@ -130,32 +215,50 @@ class ChatAIHandler:
 
         self._bot_name = bot_name
         self._chat_history_length = chat_history_length
+        self.set_post_processing(post_processing)
 
+        self._default_prompt_profile = PromptProfile.from_text(initial_prompt)
+        self._guild_prompt_profiles = {}
+        self._channel_prompt_profiles = {}
+        self._configured_guild_prompts = set()
+        self._configured_channel_prompts = set()
         self.clear_history(clear_all_channels=True)
-        self.set_system_prompt(initial_prompt)
 
         self._model_name = model_name
-        self._client = AsyncOpenAI()
+        self._client = client or AsyncOpenAI()
 
         self._ai_parameters = ai_parameters
+        self._usage_budget = usage_budget
+        # Handlers can share a tracker so budgets cover all of the bot's token usage
+        self._usage = usage_tracker or UsageTracker()
         self._debug = debug
         print(f"Starting ChatAI with ai_parameters: {asdict(self._ai_parameters)}")
 
-    def _get_system_prompts(self, channel_id: str) -> list[ChannelMemoryItem]:
-        return [
-            *self._primary_system_prompts,
-        ]
+    def _get_prompt_profile(
+        self, channel_id: str, guild_id: str | None = None
+    ) -> PromptProfile:
+        if channel_id in self._channel_prompt_profiles:
+            return self._channel_prompt_profiles[channel_id]
+        if guild_id and guild_id in self._guild_prompt_profiles:
+            return self._guild_prompt_profiles[guild_id]
+        return self._default_prompt_profile
 
     def initialise_channel_history(
-        self, channel_id: str, messages: list[ChannelMemoryItem] | None = None
+        self,
+        channel_id: str,
+        messages: list[ChannelMemoryItem] | None = None,
+        guild_id: str | None = None,
     ) -> None:
         self._conversation_history[channel_id] = ChannelMemory(
             bot_name=self._bot_name,
             channel_id=channel_id,
-            system_prompts=self._get_system_prompts(channel_id),
+            guild_id=guild_id,
+            prompt_profile=self._get_prompt_profile(channel_id, guild_id),
             messages=messages or [],
             max_length=self._chat_history_length,
         )
+        if guild_id:
+            self._guild_channels.setdefault(guild_id, set()).add(channel_id)
 
     def _append_channel_history(
         self,
@@ -163,81 +266,289 @@ class ChatAIHandler:
         role: Role,
         message: str,
         username: str | None = None,
+        guild_id: str | None = None,
     ) -> None:
         if not self._conversation_history.get(channel_id):
-            self.initialise_channel_history(channel_id)
+            self.initialise_channel_history(channel_id, guild_id=guild_id)
 
         self._conversation_history[channel_id].append_message(
             ChannelMemoryItem(role=role, text=message, username=username)
         )
 
-    def set_system_prompt(self, text: str) -> None:
-        self._primary_system_prompts = [
-            ChannelMemoryItem(
-                role=Role.system,
-                username=None,
-                text=text,
-            ),
-        ]
+    def _rebind_prompt_profiles(self, channel_ids: set[str]) -> None:
+        for channel_id in channel_ids:
+            memory = self._conversation_history.get(channel_id)
+            if memory:
+                memory.prompt_profile = self._get_prompt_profile(
+                    channel_id, memory.guild_id
+                )
+
+    def set_system_prompt(
+        self,
+        text: str,
+        guild_id: str | None = None,
+        channel_id: str | None = None,
+    ) -> None:
+        """
+        Set the system prompt for a channel, a guild or (if neither is given) the default.
+
+        Existing profiles are updated in place so every channel sharing them picks up the
+        change. Only creating a new override has to rebind the channels it covers.
+        """
+        if channel_id:
+            profiles, key, affected = (
+                self._channel_prompt_profiles,
+                channel_id,
+                {channel_id},
+            )
+        elif guild_id:
+            profiles, key, affected = (
+                self._guild_prompt_profiles,
+                guild_id,
+                self._guild_channels.get(guild_id, set()),
+            )
+        else:
+            self._default_prompt_profile.set_text(text)
+            return
+
+        if key in profiles:
+            profiles[key].set_text(text)
+            return
+
+        profiles[key] = PromptProfile.from_text(text)
+        self._rebind_prompt_profiles(affected)
+
+    def reset_system_prompt(
+        self, guild_id: str | None = None, channel_id: str | None = None
+    ) -> None:
+        """Remove a channel or guild prompt override so it falls back to the next scope up"""
+        if channel_id:
+            if self._channel_prompt_profiles.pop(channel_id, None):
+                self._rebind_prompt_profiles({channel_id})
+        elif guild_id:
+            if self._guild_prompt_profiles.pop(guild_id, None):
+                self._rebind_prompt_profiles(self._guild_channels.get(guild_id, set()))
+
+    def apply_prompt_profiles(
+        self, guild_prompts: dict[str, str], channel_prompts: dict[str, str]
+    ) -> None:
+        """
+        Apply the guild and channel prompts from the prompts file.
+
+        Overrides that were loaded from a previous version of the file but have since been
+        removed from it are reset. Overrides set at runtime with `set_system_prompt` are
+        kept until the file sets the same guild or channel.
+        """
+        for guild_id in self._configured_guild_prompts - guild_prompts.keys():
+            self.reset_system_prompt(guild_id=guild_id)
+        for channel_id in self._configured_channel_prompts - channel_prompts.keys():
+            self.reset_system_prompt(channel_id=channel_id)
 
-        for channel_id in self._conversation_history:
-            self._conversation_history[
-                channel_id
-            ].system_prompts = self._get_system_prompts(channel_id)
+        for guild_id, text in guild_prompts.items():
+            self.set_system_prompt(text, guild_id=guild_id)
+        for channel_id, text in channel_prompts.items():
+            self.set_system_prompt(text, channel_id=channel_id)
+
+        self._configured_guild_prompts = set(guild_prompts)
+        self._configured_channel_prompts = set(channel_prompts)
+
+    def set_ai_parameters(
+        self,
+        ai_parameters: AIParametersConfig,
+        model_name: str | None = None,
+        chat_history_length: int | None = None,
+    ) -> None:
+        """
+        Swap in new AI parameters without touching the existing conversation history.
+
+        In-flight requests keep using the parameters they started with.
+        """
+        self._ai_parameters = ai_parameters
+        if model_name:
+            self._model_name = model_name
+
+        if (
+            chat_history_length is not None
+            and chat_history_length != self._chat_history_length
+        ):
+            self._chat_history_length = chat_history_length
+            for memory in self._conversation_history.values():
+                memory.max_length = chat_history_length
+
+    @property
+    def usage(self) -> UsageTracker:
+        return self._usage
+
+    def set_usage_budget(self, usage_budget: UsageBudgetConfig | None) -> None:
+        self._usage_budget = usage_budget
+
+    def is_over_budget(self, channel_id: str, guild_id: str | None = None) -> bool:
+        budget = self._usage_budget
+        if not budget:
+            return False
+
+        window_seconds = budget.window_hours * 3600
+        if budget.channel_token_budget and (
+            self._usage.channel_usage(channel_id, window_seconds).total_tokens
+            >= budget.channel_token_budget
+        ):
+            return True
+
+        return bool(
+            guild_id
+            and budget.guild_token_budget
+            and self._usage.guild_usage(guild_id, window_seconds).total_tokens
+            >= budget.guild_token_budget
+        )
 
     def clear_history(
         self, clear_all_channels: bool = False, channels: set[str] | None = None
     ) -> None:
         if clear_all_channels or not channels:
             self._conversation_history = {}
+            self._guild_channels = {}
             return
 
         for channel in channels:
-            self.initialise_channel_history(channel)
+            memory = self._conversation_history.get(channel)
+            self.initialise_channel_history(
+                channel, guild_id=memory.guild_id if memory else None
+            )
+
+    def channel_memory_sizes(self) -> list[tuple[str, int, int]]:
+        """Returns (channel id, number of messages, approximate bytes) for each channel"""
+        return [
+            (channel_id, len(memory), memory.approximate_size)
+            for channel_id, memory in self._conversation_history.items()
+        ]
+
+    def forget_channel(self, channel_id: str) -> None:
+        memory = self._conversation_history.pop(channel_id, None)
+        if memory and memory.guild_id:
+            self._guild_channels.get(memory.guild_id, set()).discard(channel_id)
+
+    def set_post_processing(self, config: PostProcessingConfig | None) -> None:
+        # Stages are compiled here rather than per response
+        self._post_processor = PostProcessor(bot_name=self._bot_name, config=config)
+
+    @property
+    def post_processor(self) -> PostProcessor:
+        return self._post_processor
+
+    def split_message(self, text: str) -> list[str]:
+        return self._post_processor.split(text)
 
     def _clean_response(self, text: str) -> str:
-        # Remove bot name and colon from response text (not always present but sometimes)
-        pattern = rf"^{re.escape(self._bot_name)}\s*:\s*"
-        return re.sub(pattern, "", text, flags=re.IGNORECASE).strip()
+        return self._post_processor.process(text)
+
+    def build_completion_request(
+        self, channel_id: str, downgrade: bool = False
+    ) -> dict:
+        """
+        Build the chat completion request body for a channel's current memory.
+
+        Args:
+            channel_id (str): The channel to build the request for.
+            downgrade (bool): Use the usage budget's cheaper model and shorter history.
+
+        Returns:
+            dict: Keyword arguments for `chat.completions.create` (or a batch request body).
+        """
+        ai_parameters = self._ai_parameters
+        model_name = self._model_name
+        max_messages = None
+        if downgrade and self._usage_budget:
+            model_name = self._usage_budget.model_name or model_name
+            max_messages = self._usage_budget.max_history_size
+
+        return {
+            "model": model_name,
+            "messages": self._conversation_history[channel_id].export_as_openai_type(
+                condense=True, max_messages=max_messages
+            ),
+            "max_completion_tokens": ai_parameters.max_tokens,
+            "response_format": {"type": "text"},
+            "temperature": ai_parameters.temperature,
+            "top_p": ai_parameters.top_p,
+            "presence_penalty": ai_parameters.presence_penalty,
+            "frequency_penalty": ai_parameters.frequency_penalty,
+        }
+
+    def build_one_off_completion_request(
+        self,
+        channel_id: str,
+        message: ChannelMemoryItem,
+        history: list[ChannelMemoryItem] | None = None,
+        guild_id: str | None = None,
+    ) -> dict:
+        """
+        Build the request body for replying to `message` after `history`, without keeping
+        anything in the channel's memory afterwards.
+        """
+        self.initialise_channel_history(
+            channel_id=channel_id, messages=list(history or []), guild_id=guild_id
+        )
+        try:
+            self._append_channel_history(
+                channel_id, message.role, message.text, message.username, guild_id
+            )
+            return self.build_completion_request(channel_id)
+        finally:
+            self.forget_channel(channel_id)
 
     async def get_response(
+        self,
+        channel_id: str,
+        message_text: str,
+        reply_to_username: str | None = None,
+        guild_id: str | None = None,
+        downgrade: bool = False,
+    ) -> str:
+        response = await self.get_completion(
+            channel_id=channel_id,
+            message_text=message_text,
+            reply_to_username=reply_to_username,
+            guild_id=guild_id,
+            downgrade=downgrade,
+        )
+        return response.text
+
+    async def get_completion(
         self,
         channel_id: str,
         message_text: str,
         reply_to_username: str | None = None,
         skip_history: bool = False,
         retry_attempt: int | None = None,
-    ) -> str:
+        guild_id: str | None = None,
+        downgrade: bool = False,
+    ) -> ChatAIResponse:
         if not retry_attempt:
             retry_attempt = 0
 
         try:
             if not skip_history:
                 self._append_channel_history(
-                    channel_id, Role.user, message_text, reply_to_username
+                    channel_id, Role.user, message_text, reply_to_username, guild_id
                 )
             response = await self._client.chat.completions.create(
-                model=self._model_name,
-                messages=self._conversation_history[channel_id].export_as_openai_type(
-                    condense=True
-                ),
-                max_completion_tokens=self._ai_parameters.max_tokens,
-                response_format={"type": "text"},
-                temperature=self._ai_parameters.temperature,
-                top_p=self._ai_parameters.top_p,
-                presence_penalty=self._ai_parameters.presence_penalty,
-                frequency_penalty=self._ai_parameters.frequency_penalty,
+                **self.build_completion_request(channel_id, downgrade=downgrade)
             )
+            self._usage.record(channel_id, response.usage, guild_id=guild_id)
 
-            response_text = self._clean_response(response.choices[0].message.content)
+            response_text = self._clean_response(
+                response.choices[0].message.content or ""
+            )
             if not response_text and retry_attempt < 3:
                 # Retry generating a response 3 times
-                return await self.get_response(
+                return await self.get_completion(
                     channel_id=channel_id,
                     message_text=message_text,
                     reply_to_username=reply_to_username,
                     skip_history=True,
                     retry_attempt=retry_attempt + 1,
+                    guild_id=guild_id,
+                    downgrade=downgrade,
                 )
             elif retry_attempt == 3:
                 # If all retries fail, return a default message
@@ -245,11 +556,15 @@ class ChatAIHandler:
                     "I have no thoughts on the matter (failed to generate a response)"
                 )
 
-            self._append_channel_history(channel_id, Role.assistant, response_text)
+            self._append_channel_history(
+                channel_id, Role.assistant, response_text, guild_id=guild_id
+            )
             if self._debug:
                 response_text = f"DEBUG: {response_text}"
 
-            return response_text
+            return ChatAIResponse(
+                text=response_text, model=response.model, usage=response.usage
+            )
         except Exception as e:
             print(f"{__name__} get_response error: {e}")
             raise ChatAIException(f"error generating response: {e}")
@@ -0,0 +1,298 @@
+import asyncio
+import csv
+import json
+import time
+from dataclasses import asdict, dataclass, fields
+from pathlib import Path
+
+from openai import AsyncOpenAI, OpenAIError
+from openai.types import CompletionUsage
+
+from chat_ai.chatai_handler import (
+    ChannelMemoryItem,
+    ChatAIHandler,
+    Role,
+)
+from config import PromptProfilesConfig
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_FINISHED_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+class EvaluationException(Exception):
+    pass
+
+
+@dataclass
+class Transcript:
+    """
+    An exported channel transcript. The last message is the one the bot is asked to reply
+    to and everything before it is loaded into the channel's memory.
+    """
+
+    transcript_id: str
+    channel_id: str
+    guild_id: str | None
+    history: list[ChannelMemoryItem]
+    message: ChannelMemoryItem
+
+    @property
+    def memory_key(self) -> str:
+        # Transcripts can come from the same channel so don't let their memories collide
+        return f"{self.transcript_id}:{self.channel_id}"
+
+
+@dataclass
+class EvaluationResult:
+    transcript_id: str
+    channel_id: str
+    model: str | None = None
+    response: str | None = None
+    prompt_tokens: int | None = None
+    completion_tokens: int | None = None
+    cached_tokens: int | None = None
+    total_tokens: int | None = None
+    latency_seconds: float | None = None
+    error: str | None = None
+
+    def set_usage(self, usage: CompletionUsage | None) -> None:
+        if not usage:
+            return
+
+        self.prompt_tokens = usage.prompt_tokens
+        self.completion_tokens = usage.completion_tokens
+        self.total_tokens = usage.total_tokens
+        if usage.prompt_tokens_details:
+            self.cached_tokens = usage.prompt_tokens_details.cached_tokens
+
+
+def load_transcripts(path: Path) -> list[Transcript]:
+    """
+    Load transcripts from a JSONL file where each line looks like:
+
+        {"id": "...", "channel_id": "...", "guild_id": "...",
+         "messages": [{"username": "...", "text": "...", "role": "user"}, ...]}
+
+    `id`, `guild_id` and `role` are optional (`role` defaults to "user").
+    """
+    transcripts = []
+    memory_keys: dict[str, int] = {}
+    with path.open() as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+
+            try:
+                data = json.loads(line)
+                messages = [
+                    ChannelMemoryItem(
+                        text=message["text"],
+                        username=message.get("username"),
+                        role=Role(message.get("role", Role.user.value)),
+                    )
+                    for message in data["messages"]
+                ]
+                channel_id = str(data["channel_id"])
+            except (KeyError, TypeError, ValueError) as e:
+                raise EvaluationException(
+                    f"invalid transcript on line {line_number}: {e}"
+                )
+
+            if not messages or messages[-1].role != Role.user:
+                raise EvaluationException(
+                    f"transcript on line {line_number} must end with a user message"
+                )
+
+            transcript = Transcript(
+                transcript_id=str(data.get("id", line_number)),
+                channel_id=channel_id,
+                guild_id=str(data["guild_id"]) if data.get("guild_id") else None,
+                history=messages[:-1],
+                message=messages[-1],
+            )
+            # Transcripts sharing a key would share (and clear) each other's memory
+            if transcript.memory_key in memory_keys:
+                raise EvaluationException(
+                    f"transcript on line {line_number} has the same id and channel_id "
+                    f"as the one on line {memory_keys[transcript.memory_key]}"
+                )
+            memory_keys[transcript.memory_key] = line_number
+            transcripts.append(transcript)
+
+    return transcripts
+
+
+def apply_prompt_profiles(
+    chat_ai: ChatAIHandler,
+    transcripts: list[Transcript],
+    prompt_profiles: PromptProfilesConfig,
+) -> None:
+    """
+    Give each transcript the guild or channel prompt it would get in production.
+
+    Channel prompts are keyed by the transcript's memory key rather than its channel id,
+    since that's the channel id the handler sees during the replay.
+    """
+    chat_ai.apply_prompt_profiles(
+        guild_prompts=prompt_profiles.guilds,
+        channel_prompts={
+            transcript.memory_key: prompt_profiles.channels[transcript.channel_id]
+            for transcript in transcripts
+            if transcript.channel_id in prompt_profiles.channels
+        },
+    )
+
+
+async def _evaluate_transcript(
+    chat_ai: ChatAIHandler, transcript: Transcript, semaphore: asyncio.Semaphore
+) -> EvaluationResult:
+    result = EvaluationResult(
+        transcript_id=transcript.transcript_id, channel_id=transcript.channel_id
+    )
+    async with semaphore:
+        chat_ai.initialise_channel_history(
+            channel_id=transcript.memory_key,
+            messages=list(transcript.history),
+            guild_id=transcript.guild_id,
+        )
+        start = time.perf_counter()
+        try:
+            response = await chat_ai.get_completion(
+                channel_id=transcript.memory_key,
+                message_text=transcript.message.text,
+                reply_to_username=transcript.message.username,
+                guild_id=transcript.guild_id,
+            )
+        except Exception as e:
+            result.error = str(e)
+        else:
+            result.model = response.model
+            result.response = response.text
+            result.set_usage(response.usage)
+        result.latency_seconds = time.perf_counter() - start
+        chat_ai.forget_channel(transcript.memory_key)
+
+    return result
+
+
+async def evaluate_transcripts(
+    chat_ai: ChatAIHandler, transcripts: list[Transcript], concurrency: int = 4
+) -> list[EvaluationResult]:
+    """Replay transcripts through the handler, running at most `concurrency` at a time"""
+    if concurrency < 1:
+        raise EvaluationException("concurrency must be at least 1")
+
+    semaphore = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(
+        *[
+            _evaluate_transcript(chat_ai, transcript, semaphore)
+            for transcript in transcripts
+        ]
+    )
+
+
+async def evaluate_transcripts_batch(
+    chat_ai: ChatAIHandler,
+    client: AsyncOpenAI,
+    transcripts: list[Transcript],
+    poll_interval: float = 5.0,
+) -> list[EvaluationResult]:
+    """
+    Submit every transcript as a single batch job and wait for it to finish.
+
+    Per-request latencies aren't available in batch mode so `latency_seconds` is the
+    wall time of the whole batch.
+    """
+    requests = [
+        {
+            "custom_id": transcript.memory_key,
+            "method": "POST",
+            "url": BATCH_ENDPOINT,
+            "body": chat_ai.build_one_off_completion_request(
+                channel_id=transcript.memory_key,
+                message=transcript.message,
+                history=transcript.history,
+                guild_id=transcript.guild_id,
+            ),
+        }
+        for transcript in transcripts
+    ]
+
+    start = time.perf_counter()
+    batch_input = "\n".join(json.dumps(request) for request in requests)
+    try:
+        input_file = await client.files.create(
+            file=("batch.jsonl", batch_input.encode()), purpose="batch"
+        )
+        batch = await client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window="24h",
+        )
+        while batch.status not in BATCH_FINISHED_STATUSES:
+            await asyncio.sleep(poll_interval)
+            batch = await client.batches.retrieve(batch.id)
+
+        if not batch.output_file_id:
+            raise EvaluationException(f"batch {batch.id} finished as {batch.status}")
+
+        output = await client.files.content(batch.output_file_id)
+    except OpenAIError as e:
+        raise EvaluationException(f"batch request failed: {e}")
+    elapsed = time.perf_counter() - start
+
+    outputs = {}
+    for line in output.text.splitlines():
+        if line.strip():
+            data = json.loads(line)
+            outputs[data["custom_id"]] = data
+
+    results = []
+    for transcript in transcripts:
+        result = EvaluationResult(
+            transcript_id=transcript.transcript_id,
+            channel_id=transcript.channel_id,
+            latency_seconds=elapsed,
+        )
+        data = outputs.get(transcript.memory_key)
+        if not data:
+            result.error = "missing from batch output"
+        elif data.get("error") or data["response"]["status_code"] != 200:
+            result.error = json.dumps(data.get("error") or data["response"]["body"])
+        else:
+            body = data["response"]["body"]
+            result.model = body["model"]
+            result.response = chat_ai.post_processor.process(
+                body["choices"][0]["message"]["content"] or ""
+            )
+            if body.get("usage"):
+                result.set_usage(CompletionUsage.model_validate(body["usage"]))
+        results.append(result)
+
+    return results
+
+
+def write_results(results: list[EvaluationResult], path: Path) -> None:
+    """Write results as Parquet (requires pyarrow) if the path ends in .parquet, else CSV"""
+    columns = [field.name for field in fields(EvaluationResult)]
+
+    if path.suffix == ".parquet":
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise EvaluationException("writing .parquet results requires pyarrow")
+
+        table = pa.table(
+            {
+                column: [getattr(result, column) for result in results]
+                for column in columns
+            }
+        )
+        pq.write_table(table, path)
+        return
+
+    with path.open("w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(asdict(result) for result in results)
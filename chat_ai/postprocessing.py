@@ -0,0 +1,178 @@
+import re
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from config import PostProcessingConfig
+
+ZERO_WIDTH_SPACE = "\u200b"
+DISCORD_MAX_MESSAGE_LENGTH = 2000
+
+MASS_MENTION_PATTERN = re.compile(r"@(everyone|here)")
+ROLE_MENTION_PATTERN = re.compile(r"<@&\d+>")
+CODE_FENCE = "```"
+CLOSING_FENCE = f"\n{CODE_FENCE}"
+
+
+class ResponseStream:
+    """
+    Cleans up a response as it arrives in chunks.
+
+    Text is processed a line at a time once each line is complete, so every chunk is only
+    scanned once no matter how long the response gets.
+    """
+
+    def __init__(self, post_processor: "PostProcessor"):
+        self._post_processor = post_processor
+        self._buffer = ""
+        self._previous_line: str | None = None
+        self._in_code_block = False
+        self._is_first_line = True
+        self._pending_blank_lines = 0
+
+    def feed(self, chunk: str) -> str:
+        """Add a chunk of the response and return any newly cleaned text"""
+        self._buffer += chunk
+        if "\n" not in chunk:
+            return ""
+
+        *lines, self._buffer = self._buffer.split("\n")
+        return "".join(self._process_line(line) for line in lines)
+
+    def finish(self) -> str:
+        """Flush whatever is left of the response once it has finished arriving"""
+        text = self._process_line(self._buffer, is_last=True)
+        self._buffer = ""
+        return text
+
+    def _process_line(self, line: str, is_last: bool = False) -> str:
+        post_processor = self._post_processor
+        if self._is_first_line:
+            line = post_processor.name_prefix_pattern.sub("", line)
+
+        is_fence = line.strip().startswith(CODE_FENCE)
+        is_code = self._in_code_block or is_fence
+        if is_fence:
+            self._in_code_block = not self._in_code_block
+
+        # Mentions don't ping inside code blocks, so leave code untouched
+        if post_processor.sanitise_mentions and not is_code:
+            line = MASS_MENTION_PATTERN.sub(f"@{ZERO_WIDTH_SPACE}\\1", line)
+            line = ROLE_MENTION_PATTERN.sub(f"@{ZERO_WIDTH_SPACE}role", line)
+
+        normalised_line = line.strip().lower()
+        if not normalised_line:
+            # Hold back blank lines so leading and trailing ones can be dropped
+            if not self._is_first_line:
+                self._pending_blank_lines += 1
+            return ""
+
+        if post_processor.dedupe_lines and not is_code:
+            # Only drop a line that repeats the one before it (the model getting stuck in
+            # a loop) along with the blank lines leading up to it
+            if normalised_line == self._previous_line:
+                self._pending_blank_lines = 0
+                return ""
+        self._previous_line = None if is_code else normalised_line
+
+        if self._is_first_line:
+            line = line.lstrip()
+        if is_last:
+            line = line.rstrip()
+
+        text = "\n" * self._pending_blank_lines + line
+        if not self._is_first_line:
+            text = "\n" + text
+
+        self._is_first_line = False
+        self._pending_blank_lines = 0
+        return text
+
+
+class PostProcessor:
+    """Response clean up stages, compiled once for a bot name and config"""
+
+    def __init__(self, bot_name: str, config: "PostProcessingConfig | None" = None):
+        # Without a config only the bot name prefix is stripped
+        self.sanitise_mentions = bool(config and config.sanitise_mentions)
+        self.dedupe_lines = bool(config and config.dedupe_lines)
+        self.max_message_length = (
+            config.max_message_length if config else DISCORD_MAX_MESSAGE_LENGTH
+        )
+        # The model sometimes starts its reply with its own name, e.g. "bot: hello"
+        self.name_prefix_pattern = re.compile(
+            rf"^\s*{re.escape(bot_name)}\s*:\s*", flags=re.IGNORECASE
+        )
+
+    def stream(self) -> ResponseStream:
+        return ResponseStream(self)
+
+    def process(self, text: str) -> str:
+        stream = self.stream()
+        return (stream.feed(text) + stream.finish()).strip()
+
+    def split(self, text: str) -> list[str]:
+        """
+        Split text into Discord sized messages, breaking on newlines where possible.
+
+        A code block that gets split is closed at the end of one message and reopened
+        (with its language tag) at the start of the next, so each message renders.
+        """
+        max_length = min(self.max_message_length, DISCORD_MAX_MESSAGE_LENGTH)
+
+        messages = []
+        while len(text) > max_length:
+            # A message starting with a fence has to keep it along with some of the code
+            first_line = text.split("\n", 1)[0]
+            min_split = len(first_line) if _is_fence(first_line) else 0
+
+            split_at, rest_at = _find_split(text, min_split, max_length)
+            fence, fence_at = _unclosed_fence(text[:split_at])
+            if fence and max_length - len(CLOSING_FENCE) > min_split + 1:
+                if fence_at > min_split + 1:
+                    # Start the block in the next message rather than splitting it here
+                    split_at, rest_at = fence_at - 1, fence_at
+                else:
+                    split_at, rest_at = _find_split(
+                        text, min_split, max_length - len(CLOSING_FENCE)
+                    )
+                fence, _ = _unclosed_fence(text[:split_at])
+
+            message, text = text[:split_at], text[rest_at:]
+            if fence:
+                message += CLOSING_FENCE
+                text = f"{fence}\n{text}"
+            messages.append(message)
+
+        if text:
+            messages.append(text)
+        return messages
+
+
+def _is_fence(line: str) -> bool:
+    return line.strip().startswith(CODE_FENCE)
+
+
+def _find_split(text: str, start: int, end: int) -> tuple[int, int]:
+    """
+    Find where to split text before `end` but after `start`. Returns where the message
+    ends and where the rest starts, so only the newline or space split on is dropped.
+    """
+    for separator in ("\n", " "):
+        split_at = text.rfind(separator, start + 1, end)
+        if split_at > 0:
+            return split_at, split_at + 1
+    end = max(end, start + 1)
+    return end, end
+
+
+def _unclosed_fence(text: str) -> tuple[str | None, int]:
+    """The opening fence line of a code block left open at the end of text, and its index"""
+    fence = None
+    fence_at = 0
+    line_start = 0
+    for line in text.split("\n"):
+        if _is_fence(line):
+            fence = None if fence else line.strip()
+            fence_at = line_start
+        line_start += len(line) + 1
+    return fence, fence_at
@@ -0,0 +1,139 @@
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from openai.types import CompletionUsage
+
+# Longest window usage can be reported or budgeted over
+MAX_WINDOW_HOURS = 24 * 7
+
+
+@dataclass(slots=True)
+class TokenCounts:
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: int = 0
+    requests: int = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add_usage(self, usage: "CompletionUsage") -> None:
+        self.prompt_tokens += usage.prompt_tokens
+        self.completion_tokens += usage.completion_tokens
+        if usage.prompt_tokens_details and usage.prompt_tokens_details.cached_tokens:
+            self.cached_tokens += usage.prompt_tokens_details.cached_tokens
+        self.requests += 1
+
+    def add_counts(self, counts: "TokenCounts") -> None:
+        self.prompt_tokens += counts.prompt_tokens
+        self.completion_tokens += counts.completion_tokens
+        self.cached_tokens += counts.cached_tokens
+        self.requests += counts.requests
+
+
+class _BucketedCounts:
+    """Token counts for one channel or guild, aggregated into fixed-width time buckets"""
+
+    def __init__(self, bucket_seconds: int, retention_buckets: int):
+        self._bucket_seconds = bucket_seconds
+        self._buckets: deque[tuple[int, TokenCounts]] = deque(
+            maxlen=retention_buckets
+        )
+
+    def add_usage(self, usage: "CompletionUsage", now: float) -> None:
+        bucket = int(now // self._bucket_seconds)
+        if not self._buckets or self._buckets[-1][0] != bucket:
+            self._buckets.append((bucket, TokenCounts()))
+        self._buckets[-1][1].add_usage(usage)
+
+    def total(self, window_seconds: int, now: float) -> TokenCounts:
+        """
+        Total every bucket that overlaps the window. The window is effectively rounded up
+        to whole buckets, so budgets err on the side of counting too much.
+        """
+        oldest_bucket = int((now - window_seconds) // self._bucket_seconds)
+        counts = TokenCounts()
+        for bucket, bucket_counts in reversed(self._buckets):
+            if bucket < oldest_bucket:
+                break
+            counts.add_counts(bucket_counts)
+        return counts
+
+
+class UsageTracker:
+    """
+    Keeps running per-channel and per-guild token counters.
+
+    Usage is folded into hourly (by default) buckets as it's recorded, so memory is bounded
+    by the number of channels and the retention period rather than the number of requests.
+    """
+
+    def __init__(
+        self,
+        bucket_seconds: int = 3600,
+        # One more than the longest window since a window can overlap a partial bucket
+        retention_buckets: int = MAX_WINDOW_HOURS + 1,
+    ):
+        self._bucket_seconds = bucket_seconds
+        self._retention_buckets = retention_buckets
+        self._channels: dict[str, _BucketedCounts] = {}
+        self._guilds: dict[str, _BucketedCounts] = {}
+
+    @property
+    def retention_seconds(self) -> int:
+        return self._bucket_seconds * self._retention_buckets
+
+    def _get_counts(
+        self, counts: dict[str, _BucketedCounts], key: str
+    ) -> _BucketedCounts:
+        if key not in counts:
+            counts[key] = _BucketedCounts(
+                self._bucket_seconds, self._retention_buckets
+            )
+        return counts[key]
+
+    def record(
+        self,
+        channel_id: str,
+        usage: "CompletionUsage | None",
+        guild_id: str | None = None,
+    ) -> None:
+        if not usage:
+            return
+
+        now = time.time()
+        self._get_counts(self._channels, channel_id).add_usage(usage, now)
+        if guild_id:
+            self._get_counts(self._guilds, guild_id).add_usage(usage, now)
+
+    def channel_usage(self, channel_id: str, window_seconds: int) -> TokenCounts:
+        if channel_id not in self._channels:
+            return TokenCounts()
+        return self._channels[channel_id].total(window_seconds, time.time())
+
+    def guild_usage(self, guild_id: str, window_seconds: int) -> TokenCounts:
+        if guild_id not in self._guilds:
+            return TokenCounts()
+        return self._guilds[guild_id].total(window_seconds, time.time())
+
+    def _top(
+        self, counts: dict[str, _BucketedCounts], window_seconds: int, limit: int
+    ) -> list[tuple[str, TokenCounts]]:
+        now = time.time()
+        totals = [(key, c.total(window_seconds, now)) for key, c in counts.items()]
+        totals.sort(key=lambda item: item[1].total_tokens, reverse=True)
+        return [item for item in totals[:limit] if item[1].requests]
+
+    def top_channels(
+        self, window_seconds: int, limit: int = 10
+    ) -> list[tuple[str, TokenCounts]]:
+        return self._top(self._channels, window_seconds, limit)
+
+    def top_guilds(
+        self, window_seconds: int, limit: int = 10
+    ) -> list[tuple[str, TokenCounts]]:
+        return self._top(self._guilds, window_seconds, limit)
@@ -1,6 +1,14 @@
+import asyncio
+import signal
+import tomllib
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from pathlib import Path
 from typing import Annotated
 
-from pymicroconf import BaseConfig, ConfigField
+from pymicroconf import BaseConfig, ConfigField, ConfigHandler, InvalidConfigException
+
+from chat_ai.usage import MAX_WINDOW_HOURS
 
 
 class AIParametersConfig(BaseConfig):
@@ -10,6 +18,58 @@ class AIParametersConfig(BaseConfig):
     presence_penalty: Annotated[float, ConfigField("PRESENCE_PENALTY", default=0.4)]
     max_tokens: Annotated[int, ConfigField("MAX_TOKENS", default=500)]
     max_history_size: Annotated[int, ConfigField("MAX_HISTORY_SIZE", default=50)]
+    reply_chance: Annotated[float, ConfigField("REPLY_CHANCE", default=0.01)]
+    emoji_reply_chance: Annotated[
+        float, ConfigField("EMOJI_REPLY_CHANCE", default=0.005)
+    ]
+
+    def validate(self) -> None:
+        if not 0 <= self.temperature <= 2:
+            raise InvalidConfigException("temperature must be between 0 and 2")
+        if not 0 <= self.top_p <= 1:
+            raise InvalidConfigException("top_p must be between 0 and 1")
+        if self.max_tokens <= 0:
+            raise InvalidConfigException("max_tokens must be positive")
+        if self.max_history_size < 1:
+            raise InvalidConfigException("max_history_size must be at least 1")
+        if not 0 <= self.reply_chance <= 1 or not 0 <= self.emoji_reply_chance <= 1:
+            raise InvalidConfigException("reply chances must be between 0 and 1")
+
+
+class UsageBudgetConfig(BaseConfig):
+    channel_token_budget: Annotated[
+        int, ConfigField("CHANNEL_TOKEN_BUDGET", default=0)
+    ]
+    guild_token_budget: Annotated[int, ConfigField("GUILD_TOKEN_BUDGET", default=0)]
+    window_hours: Annotated[int, ConfigField("BUDGET_WINDOW_HOURS", default=24)]
+    model_name: Annotated[str, ConfigField("BUDGET_MODEL_NAME", default="")]
+    max_history_size: Annotated[
+        int, ConfigField("BUDGET_MAX_HISTORY_SIZE", default=10)
+    ]
+
+    def validate(self) -> None:
+        if self.channel_token_budget < 0 or self.guild_token_budget < 0:
+            raise InvalidConfigException("token budgets can't be negative")
+        if not 0 < self.window_hours <= MAX_WINDOW_HOURS:
+            raise InvalidConfigException(
+                f"budget window_hours must be between 1 and {MAX_WINDOW_HOURS}"
+            )
+        if self.max_history_size < 1:
+            raise InvalidConfigException("budget max_history_size must be at least 1")
+
+
+class PostProcessingConfig(BaseConfig):
+    sanitise_mentions: Annotated[bool, ConfigField("SANITISE_MENTIONS", default=True)]
+    dedupe_lines: Annotated[bool, ConfigField("DEDUPE_LINES", default=True)]
+    max_message_length: Annotated[
+        int, ConfigField("MAX_MESSAGE_LENGTH", default=2000)
+    ]
+
+    def validate(self) -> None:
+        if not 0 < self.max_message_length <= 2000:
+            raise InvalidConfigException(
+                "max_message_length must be between 1 and 2000 (Discord's limit)"
+            )
 
 
 class DiscordConfig(BaseConfig):
@@ -23,11 +83,172 @@ class OpenAIConfig(BaseConfig):
         str, ConfigField("OPENAI_MODEL_NAME", default="gpt-3.5-turbo")
     ]
     ai_parameters: AIParametersConfig
+    budget: UsageBudgetConfig
+    post_processing: PostProcessingConfig
 
 
 class Config(BaseConfig):
     bot_name: Annotated[str, ConfigField("BOT_NAME")]
     debug: Annotated[bool, ConfigField("DEBUG", default=False)]
+    prompts_file: Annotated[str, ConfigField("PROMPTS_FILE", default="prompts.toml")]
 
     discord: DiscordConfig
     openai: OpenAIConfig
+
+    def validate(self) -> None:
+        self.openai.ai_parameters.validate()
+        self.openai.budget.validate()
+        self.openai.post_processing.validate()
+
+
+@dataclass
+class PromptProfilesConfig:
+    guilds: dict[str, str] = field(default_factory=dict)
+    channels: dict[str, str] = field(default_factory=dict)
+
+
+def load_prompt_profiles(path: Path) -> PromptProfilesConfig:
+    """
+    Load per-guild and per-channel system prompts from a TOML file like:
+
+        [guilds]
+        "123456789" = "You are a pirate"
+
+        [channels]
+        "987654321" = "You only speak in haiku"
+
+    A missing file means there are no guild or channel prompts.
+    """
+    if not path.exists():
+        return PromptProfilesConfig()
+
+    try:
+        data = tomllib.loads(path.read_text())
+    except (OSError, tomllib.TOMLDecodeError) as e:
+        raise InvalidConfigException(f"invalid prompts file {path}: {e}")
+
+    profiles = PromptProfilesConfig()
+    for scope, prompts in (("guilds", profiles.guilds), ("channels", profiles.channels)):
+        table = data.get(scope, {})
+        if not isinstance(table, dict):
+            raise InvalidConfigException(f"[{scope}] in {path} must be a table")
+        for id, prompt in table.items():
+            if not isinstance(prompt, str) or not prompt.strip():
+                raise InvalidConfigException(
+                    f"prompt for {scope} {id} in {path} must be a non-empty string"
+                )
+            prompts[str(id)] = prompt
+
+    return profiles
+
+
+ConfigReloadCallback = Callable[[Config, PromptProfilesConfig], None]
+
+
+class ConfigReloader:
+    """
+    Reloads the config and prompts files on SIGHUP or when either file is modified.
+
+    New configs are validated before any callbacks run, so a bad edit leaves the
+    current config in place.
+    """
+
+    def __init__(
+        self,
+        config_handler: ConfigHandler,
+        config_file_path: Path,
+        config: Config,
+        prompt_profiles: PromptProfilesConfig,
+        poll_interval: float = 5.0,
+    ):
+        self.config = config
+        self.prompt_profiles = prompt_profiles
+        self._config_handler = config_handler
+        self._config_file_path = config_file_path
+        self._poll_interval = poll_interval
+        self._callbacks: list[ConfigReloadCallback] = []
+        self._last_mtimes = self._get_mtimes()
+        self._watch_task: asyncio.Task | None = None
+        self._reload_tasks: set[asyncio.Task] = set()
+        # Reloads from the file watcher, SIGHUP and /reloadconfig could otherwise overlap
+        # and let whichever finishes last (possibly with an older file) win
+        self._reload_lock = asyncio.Lock()
+
+    def add_callback(self, callback: ConfigReloadCallback) -> None:
+        self._callbacks.append(callback)
+
+    def _get_mtimes(self) -> tuple[float | None, ...]:
+        mtimes = []
+        for path in (self._config_file_path, Path(self.config.prompts_file)):
+            try:
+                mtimes.append(path.stat().st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    async def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGHUP, self._reload_in_background)
+        except (AttributeError, NotImplementedError):
+            print("SIGHUP config reloading isn't supported on this platform")
+
+        self._watch_task = loop.create_task(self._watch_file())
+
+    def _reload_in_background(self) -> None:
+        # Hold a reference so the task isn't garbage collected before it finishes
+        task = asyncio.get_running_loop().create_task(self.reload())
+        self._reload_tasks.add(task)
+        task.add_done_callback(self._reload_tasks.discard)
+
+    async def _watch_file(self) -> None:
+        while True:
+            await asyncio.sleep(self._poll_interval)
+            try:
+                mtimes = self._get_mtimes()
+                if mtimes != self._last_mtimes:
+                    self._last_mtimes = mtimes
+                    await self.reload()
+            except Exception as e:
+                print(f"Config file watcher error: {e}")
+
+    async def reload(self) -> bool:
+        async with self._reload_lock:
+            return await self._reload()
+
+    async def _reload(self) -> bool:
+        # Editors can leave the file half written or briefly missing while saving, so
+        # any failure to load just keeps the current config
+        try:
+            new_config = await asyncio.to_thread(self._config_handler.load_config)
+            new_config.validate()
+            prompt_profiles = await asyncio.to_thread(
+                load_prompt_profiles, Path(new_config.prompts_file)
+            )
+        except InvalidConfigException as e:
+            print(f"Not reloading invalid configuration: {e}")
+            return False
+        except Exception as e:
+            print(f"Not reloading configuration, failed to load it: {e}")
+            return False
+
+        if (
+            new_config.bot_name != self.config.bot_name
+            or new_config.discord != self.config.discord
+            or new_config.openai.api_key != self.config.openai.api_key
+        ):
+            print("bot_name, discord and api_key changes need a restart to apply")
+
+        self.config = new_config
+        self.prompt_profiles = prompt_profiles
+        success = True
+        for callback in self._callbacks:
+            try:
+                callback(new_config, prompt_profiles)
+            except Exception as e:
+                print(f"Failed to apply reloaded configuration: {e}")
+                success = False
+
+        if success:
+            print("Reloaded configuration")
+        return success
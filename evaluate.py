@@ -0,0 +1,106 @@
+import argparse
+import asyncio
+import sys
+from pathlib import Path
+
+from openai import AsyncOpenAI
+from pymicroconf import ConfigHandler, InvalidConfigException
+
+from chat_ai.chatai_handler import ChatAIHandler
+from chat_ai.evaluation import (
+    EvaluationException,
+    apply_prompt_profiles,
+    evaluate_transcripts,
+    evaluate_transcripts_batch,
+    load_transcripts,
+    write_results,
+)
+from config import Config, PromptProfilesConfig, load_prompt_profiles
+
+
+async def run(
+    args: argparse.Namespace, config: Config, prompt_profiles: PromptProfilesConfig
+) -> None:
+    transcripts = load_transcripts(Path(args.transcripts))
+    print(f"Loaded {len(transcripts)} transcripts from {args.transcripts}")
+
+    client = AsyncOpenAI(base_url=args.base_url) if args.base_url else AsyncOpenAI()
+    ai_parameters = config.openai.ai_parameters
+    chat_ai = ChatAIHandler(
+        bot_name=config.bot_name,
+        model_name=args.model or config.openai.model_name,
+        chat_history_length=ai_parameters.max_history_size,
+        ai_parameters=ai_parameters,
+        initial_prompt=Path(args.prompt).read_text() if args.prompt else None,
+        client=client,
+        post_processing=config.openai.post_processing,
+    )
+    # A prompt passed on the command line is tested everywhere instead of the prompts file
+    if not args.prompt:
+        apply_prompt_profiles(chat_ai, transcripts, prompt_profiles)
+
+    if args.batch:
+        results = await evaluate_transcripts_batch(
+            chat_ai=chat_ai, client=client, transcripts=transcripts
+        )
+    else:
+        results = await evaluate_transcripts(
+            chat_ai=chat_ai, transcripts=transcripts, concurrency=args.concurrency
+        )
+
+    write_results(results, Path(args.output))
+    failed = sum(1 for result in results if result.error)
+    print(f"Wrote {len(results)} results to {args.output} ({failed} failed)")
+
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+
+def main():
+    args = argparse.ArgumentParser(
+        description="Replay exported channel transcripts through the chat AI offline"
+    )
+    args.add_argument("transcripts", help="JSONL file of exported transcripts")
+    args.add_argument("--config", default="config.toml")
+    args.add_argument("--output", default="eval_results.csv")
+    args.add_argument("--model", help="Override the configured model name")
+    args.add_argument(
+        "--prompt",
+        help="File containing a system prompt to test (replaces the prompts file)",
+    )
+    args.add_argument("--concurrency", type=positive_int, default=4)
+    args.add_argument(
+        "--base-url", help="Base URL of an OpenAI compatible server to use instead"
+    )
+    args.add_argument(
+        "--batch",
+        action="store_true",
+        help="Submit all transcripts as one job through the batch endpoint",
+    )
+    args = args.parse_args()
+
+    config_handler = ConfigHandler(
+        config_file_path=Path(args.config), config_class=Config
+    )
+
+    try:
+        config = config_handler.load_config()
+        config.validate()
+        prompt_profiles = load_prompt_profiles(Path(config.prompts_file))
+    except InvalidConfigException as e:
+        print("Invalid configuration:", e)
+        sys.exit(1)
+
+    try:
+        asyncio.run(run(args, config, prompt_profiles))
+    except EvaluationException as e:
+        print("Evaluation failed:", e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 import argparse
 import sys
 from pathlib import Path
+from typing import Literal
 
 import discord
 from discord import Intents, app_commands
@@ -8,7 +9,8 @@ from pymicroconf import ConfigHandler, InvalidConfigException
 
 from bot.bot import ChatBot
 from chat_ai.chatai_handler import ChatAIHandler
-from config import Config
+from chat_ai.usage import MAX_WINDOW_HOURS, UsageTracker
+from config import Config, ConfigReloader, PromptProfilesConfig, load_prompt_profiles
 
 
 def main():
@@ -16,27 +18,46 @@ def main():
     args.add_argument("--config", default="config.toml")
     args = args.parse_args()
 
+    config_file_path = Path(args.config)
     config_handler = ConfigHandler(
-        config_file_path=Path(args.config), config_class=Config
+        config_file_path=config_file_path, config_class=Config
     )
 
     try:
         config = config_handler.load_config()
+        config.validate()
+        prompt_profiles = load_prompt_profiles(Path(config.prompts_file))
     except InvalidConfigException as e:
         print("Invalid configuration:", e)
         sys.exit(1)
 
+    config_reloader = ConfigReloader(
+        config_handler=config_handler,
+        config_file_path=config_file_path,
+        config=config,
+        prompt_profiles=prompt_profiles,
+    )
+
+    usage_tracker = UsageTracker()
     chat_ai = ChatAIHandler(
         bot_name=config.bot_name,
-        chat_history_length=config.openai.ai_parameters.max_tokens,
+        chat_history_length=config.openai.ai_parameters.max_history_size,
         model_name=config.openai.model_name,
         ai_parameters=config.openai.ai_parameters,
+        usage_budget=config.openai.budget,
+        usage_tracker=usage_tracker,
+        post_processing=config.openai.post_processing,
         debug=config.debug,
     )
+    chat_ai.apply_prompt_profiles(
+        guild_prompts=prompt_profiles.guilds, channel_prompts=prompt_profiles.channels
+    )
     reaction_ai = ChatAIHandler(
         bot_name="reactions",
         model_name="gpt-4o",
         chat_history_length=0,
+        usage_budget=config.openai.budget,
+        usage_tracker=usage_tracker,
         initial_prompt="Before every message, I will supply a list of strings that represent emojis. The list will begin with || and end with || and each emoji will be separated with a ,. After the emojis will be a message, I want you to take the message and choose a relevant emoji. For example, for this ||smile, cry, wave||Hello, you would respond with wave. ONLY respond with the emoji name",
         ai_parameters=config.openai.ai_parameters,
         debug=config.debug,
@@ -44,11 +65,43 @@ def main():
     discord_bot = ChatBot(
         chat_ai=chat_ai,
         reaction_ai=reaction_ai,
+        ai_parameters=config.openai.ai_parameters,
         guild_id=config.discord.guild_id,
         intents=Intents.all(),
+        config_reloader=config_reloader,
         debug=config.debug,
     )
 
+    async def ensure_admin(interaction: discord.Interaction) -> bool:
+        # default_permissions is only a default that server admins can change
+        if interaction.guild_id is None or not interaction.permissions.administrator:
+            await interaction.response.send_message(
+                "Only server admins can use this", ephemeral=True
+            )
+            return False
+        return True
+
+    def apply_config(
+        new_config: Config, new_prompt_profiles: PromptProfilesConfig
+    ) -> None:
+        ai_parameters = new_config.openai.ai_parameters
+        chat_ai.set_ai_parameters(
+            ai_parameters=ai_parameters,
+            model_name=new_config.openai.model_name,
+            chat_history_length=ai_parameters.max_history_size,
+        )
+        reaction_ai.set_ai_parameters(ai_parameters=ai_parameters)
+        discord_bot.set_ai_parameters(ai_parameters)
+        chat_ai.set_usage_budget(new_config.openai.budget)
+        chat_ai.set_post_processing(new_config.openai.post_processing)
+        reaction_ai.set_usage_budget(new_config.openai.budget)
+        chat_ai.apply_prompt_profiles(
+            guild_prompts=new_prompt_profiles.guilds,
+            channel_prompts=new_prompt_profiles.channels,
+        )
+
+    config_reloader.add_callback(apply_config)
+
     @discord_bot.tree.command(
         name="clearhistory", description=f"Clear {config.bot_name}'s history"
     )
@@ -65,14 +118,136 @@ def main():
             f"{config.bot_name}'s commands have been updated"
         )
 
+    @discord_bot.tree.command(
+        name="reloadconfig",
+        description=f"Reload {config.bot_name}'s config file without restarting",
+    )
+    @app_commands.guild_only()
+    @app_commands.default_permissions(administrator=True)
+    async def reload_config(interaction: discord.Interaction):
+        if not await ensure_admin(interaction):
+            return
+
+        await interaction.response.defer(ephemeral=True)
+        if await config_reloader.reload():
+            await interaction.followup.send("Config reloaded", ephemeral=True)
+        else:
+            await interaction.followup.send(
+                "Config is invalid, keeping the current one", ephemeral=True
+            )
+
+    @discord_bot.tree.command(
+        name="usage",
+        description=f"Show which servers and channels use the most of {config.bot_name}'s tokens",
+    )
+    @app_commands.guild_only()
+    @app_commands.default_permissions(administrator=True)
+    @app_commands.describe(hours=f"How many hours back to look (max {MAX_WINDOW_HOURS})")
+    async def show_usage(
+        interaction: discord.Interaction,
+        hours: app_commands.Range[int, 1, MAX_WINDOW_HOURS] = 24,
+    ):
+        if not await ensure_admin(interaction):
+            return
+
+        await interaction.response.send_message(
+            discord_bot.get_usage_summary(window_hours=hours), ephemeral=True
+        )
+
+    profile_group = app_commands.Group(
+        name="profile",
+        description=f"Look inside {config.bot_name} while it's running",
+        guild_only=True,
+        default_permissions=discord.Permissions(administrator=True),
+    )
+
+    @profile_group.command(
+        name="cpu", description="Sample what the event loop is doing for a while"
+    )
+    @app_commands.describe(seconds="How long to profile for (max 300)")
+    async def profile_cpu(interaction: discord.Interaction, seconds: int = 10):
+        if not await ensure_admin(interaction):
+            return
+
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        summary = await discord_bot.profiler.profile_cpu(seconds=seconds)
+        await interaction.followup.send(summary[:2000], ephemeral=True)
+
+    @profile_group.command(
+        name="memory",
+        description="Snapshot memory allocations (the first run starts tracing)",
+    )
+    @app_commands.describe(stop="Stop tracing allocations after this snapshot")
+    async def profile_memory(interaction: discord.Interaction, stop: bool = False):
+        if not await ensure_admin(interaction):
+            return
+
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        summary = await discord_bot.profiler.profile_memory(stop=stop)
+        await interaction.followup.send(summary[:2000], ephemeral=True)
+
+    @profile_group.command(
+        name="status",
+        description="Show event loop lag and the slowest recent messages",
+    )
+    async def profile_status(interaction: discord.Interaction):
+        if not await ensure_admin(interaction):
+            return
+
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        summary = await discord_bot.profiler.status()
+        await interaction.followup.send(summary[:2000], ephemeral=True)
+
+    discord_bot.tree.add_command(profile_group)
+
     @discord_bot.tree.command(
         name="setprompt", description=f"Tell {config.bot_name} who he is"
     )
-    @app_commands.describe(new_prompt="New system prompt")
-    async def set_prompt(interaction: discord.Interaction, new_prompt: str):
-        discord_bot.set_system_prompt(new_prompt)
+    @app_commands.describe(
+        new_prompt="New system prompt",
+        scope="Apply the prompt everywhere, to this server only or to this channel only",
+    )
+    async def set_prompt(
+        interaction: discord.Interaction,
+        new_prompt: str,
+        scope: Literal["global", "server", "channel"] = "global",
+    ):
+        guild_id = interaction.guild_id if scope == "server" else None
+        channel_id = interaction.channel_id if scope == "channel" else None
+        # Without an id set_system_prompt would fall through to the global prompt
+        if scope != "global" and not (guild_id or channel_id):
+            await interaction.response.send_message(
+                f"There's no {scope} to set a prompt for here", ephemeral=True
+            )
+            return
+
+        discord_bot.set_system_prompt(
+            new_prompt, guild_id=guild_id, channel_id=channel_id
+        )
+        await interaction.response.send_message(
+            f"{config.bot_name} is now prompted with {new_prompt} ({scope})"
+        )
+
+    @discord_bot.tree.command(
+        name="resetprompt",
+        description=f"Remove {config.bot_name}'s server or channel specific prompt",
+    )
+    @app_commands.describe(scope="Which prompt override to remove")
+    async def reset_prompt(
+        interaction: discord.Interaction,
+        scope: Literal["server", "channel"] = "channel",
+    ):
+        guild_id = interaction.guild_id if scope == "server" else None
+        channel_id = interaction.channel_id if scope == "channel" else None
+        if not (guild_id or channel_id):
+            await interaction.response.send_message(
+                f"There's no {scope} to reset the prompt for here", ephemeral=True
+            )
+            return
+
+        discord_bot.reset_system_prompt(guild_id=guild_id, channel_id=channel_id)
         await interaction.response.send_message(
-            f"{config.bot_name} is now prompted with {new_prompt}"
+            f"{config.bot_name}'s {scope} prompt has been reset"
         )
 
     @discord_bot.tree.command(
@@ -0,0 +1,145 @@
+from dataclasses import dataclass
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("openai")
+pytest.importorskip("pymicroconf")
+
+from chat_ai.chatai_handler import (  # noqa: E402
+    ChannelMemory,
+    ChannelMemoryItem,
+    ChatAIHandler,
+    PromptProfile,
+    Role,
+)
+
+
+@dataclass
+class AIParameters:
+    temperature: float = 1.0
+
+
+def make_handler(
+    channel_token_budget: int = 0, guild_token_budget: int = 0
+) -> ChatAIHandler:
+    return ChatAIHandler(
+        bot_name="Bot",
+        model_name="model",
+        chat_history_length=10,
+        ai_parameters=AIParameters(),
+        client=object(),
+        usage_budget=SimpleNamespace(
+            channel_token_budget=channel_token_budget,
+            guild_token_budget=guild_token_budget,
+            window_hours=24,
+        ),
+    )
+
+
+def record_usage(
+    handler: ChatAIHandler, channel_id: str, tokens: int, guild_id: str | None = None
+) -> None:
+    handler.usage.record(
+        channel_id,
+        SimpleNamespace(
+            prompt_tokens=tokens, completion_tokens=0, prompt_tokens_details=None
+        ),
+        guild_id=guild_id,
+    )
+
+
+def make_memory(max_length: int) -> ChannelMemory:
+    return ChannelMemory(
+        bot_name="Bot",
+        channel_id="1",
+        prompt_profile=PromptProfile.from_text("be nice"),
+        max_length=max_length,
+    )
+
+
+def append_messages(memory: ChannelMemory, count: int) -> None:
+    for i in range(count):
+        memory.append_message(
+            ChannelMemoryItem(text=f"message {i}", username="user", role=Role.user)
+        )
+
+
+def test_append_message_trims_to_max_length():
+    memory = make_memory(max_length=3)
+    append_messages(memory, 5)
+    assert [message.text for message in memory.messages[1:]] == [
+        "message 2",
+        "message 3",
+        "message 4",
+    ]
+
+
+def test_zero_max_length_keeps_only_latest_message():
+    memory = make_memory(max_length=0)
+    append_messages(memory, 5)
+    assert len(memory) == 1
+    assert memory.messages[-1].text == "message 4"
+
+
+def test_export_max_messages_keeps_most_recent():
+    memory = make_memory(max_length=10)
+    append_messages(memory, 5)
+    exported = memory.export_as_openai_type(max_messages=2)
+    assert exported[: len(memory.prompt_profile.payload)] == memory.prompt_profile.payload
+    assert [message["content"][0]["text"] for message in exported[-2:]] == [
+        "message 3",
+        "message 4",
+    ]
+    assert len(exported) == len(memory.prompt_profile.payload) + 2
+
+
+def test_export_max_messages_always_keeps_latest_message():
+    memory = make_memory(max_length=10)
+    append_messages(memory, 5)
+    for max_messages in (0, -1):
+        exported = memory.export_as_openai_type(max_messages=max_messages)
+        assert len(exported) == len(memory.prompt_profile.payload) + 1
+        assert exported[-1]["content"][0]["text"] == "message 4"
+
+
+def test_export_max_messages_larger_than_history():
+    memory = make_memory(max_length=10)
+    append_messages(memory, 3)
+    assert memory.export_as_openai_type(
+        max_messages=10
+    ) == memory.export_as_openai_type()
+
+
+def test_no_budget_is_never_over():
+    handler = make_handler()
+    record_usage(handler, "1", 1_000_000, guild_id="g")
+    assert not handler.is_over_budget("1", guild_id="g")
+
+
+def test_channel_budget_applies_before_guild_budget():
+    handler = make_handler(channel_token_budget=100, guild_token_budget=1_000)
+    record_usage(handler, "1", 100, guild_id="g")
+    # The channel is over budget even though its guild isn't
+    assert handler.is_over_budget("1", guild_id="g")
+    assert not handler.is_over_budget("2", guild_id="g")
+
+
+def test_guild_budget_covers_all_its_channels():
+    handler = make_handler(channel_token_budget=100, guild_token_budget=150)
+    record_usage(handler, "1", 80, guild_id="g")
+    record_usage(handler, "2", 80, guild_id="g")
+    # Each channel is under its own budget but together they exceed the guild's
+    assert handler.is_over_budget("1", guild_id="g")
+    assert handler.is_over_budget("3", guild_id="g")
+    assert not handler.is_over_budget("3", guild_id="other")
+    assert not handler.is_over_budget("3")
+
+
+def test_channel_budget_without_guild_budget():
+    handler = make_handler(channel_token_budget=100)
+    record_usage(handler, "1", 80, guild_id="g")
+    record_usage(handler, "2", 80, guild_id="g")
+    assert not handler.is_over_budget("1", guild_id="g")
+    record_usage(handler, "1", 20, guild_id="g")
+    assert handler.is_over_budget("1", guild_id="g")
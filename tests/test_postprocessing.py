@@ -0,0 +1,152 @@
+from types import SimpleNamespace
+
+from chat_ai.postprocessing import PostProcessor
+
+
+def make_post_processor(
+    sanitise_mentions: bool = True,
+    dedupe_lines: bool = True,
+    max_message_length: int = 2000,
+) -> PostProcessor:
+    return PostProcessor(
+        bot_name="Bot",
+        config=SimpleNamespace(
+            sanitise_mentions=sanitise_mentions,
+            dedupe_lines=dedupe_lines,
+            max_message_length=max_message_length,
+        ),
+    )
+
+
+def stream_in_chunks(post_processor: PostProcessor, text: str, size: int) -> str:
+    stream = post_processor.stream()
+    output = "".join(
+        stream.feed(text[i : i + size]) for i in range(0, len(text), size)
+    )
+    return (output + stream.finish()).strip()
+
+
+def test_strips_bot_name_prefix():
+    post_processor = make_post_processor()
+    assert post_processor.process("bot: hello") == "hello"
+    assert post_processor.process("  BOT : hello\nbot: again") == "hello\nbot: again"
+    assert post_processor.process("hello bot: there") == "hello bot: there"
+
+
+def test_prefix_only_stripping_without_config():
+    post_processor = PostProcessor(bot_name="Bot")
+    assert post_processor.process("Bot: @everyone hi\nhi") == "@everyone hi\nhi"
+
+
+def test_sanitises_mentions():
+    text = make_post_processor().process("hey @everyone and @here and <@&1234>")
+    assert "@everyone" not in text
+    assert "@here" not in text
+    assert "<@&1234>" not in text
+    assert text.replace("\u200b", "") == "hey @everyone and @here and @role"
+
+
+def test_leaves_mentions_in_code_blocks():
+    text = "look:\n```\n@everyone\n```"
+    assert make_post_processor().process(text) == text
+
+
+def test_dedupes_consecutive_lines_only():
+    post_processor = make_post_processor()
+    assert post_processor.process("lol\nLOL\nlol\nok") == "lol\nok"
+    assert post_processor.process("lol\nok\nlol") == "lol\nok\nlol"
+
+
+def test_dedupe_drops_blank_lines_of_removed_line():
+    assert make_post_processor().process("haha\n\nhaha\n\nlol") == "haha\n\nlol"
+
+
+def test_dedupe_keeps_code_blocks_intact():
+    text = "Bot: here's code\n```py\nx = 1\n```\nok\n```py\ny=2\n```"
+    expected = "here's code\n```py\nx = 1\n```\nok\n```py\ny=2\n```"
+    assert make_post_processor().process(text) == expected
+
+    repeated_code = "```\nprint(1)\nprint(1)\n```"
+    assert make_post_processor().process(repeated_code) == repeated_code
+
+
+def test_dedupe_can_be_disabled():
+    assert make_post_processor(dedupe_lines=False).process("a\na") == "a\na"
+
+
+def test_streaming_matches_processing_whole_text():
+    post_processor = make_post_processor()
+    text = "\n bot: hi @here\nhi\nHI\n\n\n```\nx\nx\n```\nbye\n\n"
+    expected = post_processor.process(text)
+    for size in (1, 2, 3, 7, len(text)):
+        assert stream_in_chunks(post_processor, text, size) == expected
+
+
+def test_stream_only_returns_complete_lines():
+    stream = make_post_processor().stream()
+    assert stream.feed("bot: hel") == ""
+    assert stream.feed("lo\nwor") == "hello"
+    assert stream.feed("ld") == ""
+    assert stream.finish() == "\nworld"
+
+
+def test_split_short_text_is_unchanged():
+    assert make_post_processor().split("hello") == ["hello"]
+    assert make_post_processor().split("") == []
+
+
+def test_split_prefers_newlines_then_spaces():
+    post_processor = make_post_processor(max_message_length=10)
+    assert post_processor.split("aaaa bbbb\ncccc dddd eeee") == [
+        "aaaa bbbb",
+        "cccc dddd",
+        "eeee",
+    ]
+
+
+def test_split_hard_splits_long_words():
+    post_processor = make_post_processor(max_message_length=4)
+    assert post_processor.split("abcdefghij") == ["abcd", "efgh", "ij"]
+
+
+def test_split_keeps_indentation():
+    post_processor = make_post_processor(max_message_length=20)
+    assert post_processor.split("hello there\n    indented line\nmore") == [
+        "hello there",
+        "    indented line",
+        "more",
+    ]
+
+
+def test_split_closes_and_reopens_code_blocks():
+    post_processor = make_post_processor(max_message_length=20)
+    assert post_processor.split("```py\n    a = 1\n    b = 2\n    c = 3\n```") == [
+        "```py\n    a = 1\n```",
+        "```py\n    b = 2\n```",
+        "```py\n    c = 3\n```",
+    ]
+
+
+def test_split_moves_code_block_to_next_message():
+    post_processor = make_post_processor(max_message_length=20)
+    assert post_processor.split("some text\n```py\nx = 1\n```") == [
+        "some text",
+        "```py\nx = 1\n```",
+    ]
+
+
+def test_split_code_blocks_stay_within_limit():
+    post_processor = make_post_processor(max_message_length=20)
+    messages = post_processor.split("```\n" + "x" * 40 + "\n```")
+    assert all(len(message) <= 20 for message in messages)
+    assert all(
+        message.startswith("```\n") and message.endswith("\n```")
+        for message in messages
+    )
+    assert "".join(message[4:-4] for message in messages) == "x" * 40
+
+
+def test_split_never_exceeds_discord_limit():
+    post_processor = make_post_processor(max_message_length=5000)
+    messages = post_processor.split("x" * 4500)
+    assert [len(message) for message in messages] == [2000, 2000, 500]
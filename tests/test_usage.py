@@ -0,0 +1,61 @@
+from types import SimpleNamespace
+
+from chat_ai.usage import _BucketedCounts
+
+HOUR = 3600
+
+
+def make_usage(prompt_tokens: int, completion_tokens: int = 0) -> SimpleNamespace:
+    return SimpleNamespace(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        prompt_tokens_details=None,
+    )
+
+
+def make_counts() -> _BucketedCounts:
+    counts = _BucketedCounts(bucket_seconds=HOUR, retention_buckets=5)
+    # One request in each of hours 0 to 4, worth 1, 10, 100, ... tokens
+    for hour in range(5):
+        counts.add_usage(make_usage(10**hour), now=hour * HOUR + 1)
+    return counts
+
+
+def test_total_counts_every_bucket_overlapping_the_window():
+    counts = make_counts()
+    now = 4 * HOUR + HOUR / 2
+    # Half an hour back is still in the current bucket
+    assert counts.total(HOUR // 2, now).total_tokens == 10_000
+    # An hour back reaches into hour 3, so all of it is counted
+    assert counts.total(HOUR, now).total_tokens == 11_000
+    assert counts.total(2 * HOUR, now).total_tokens == 11_100
+
+
+def test_total_window_ending_on_a_bucket_boundary():
+    counts = make_counts()
+    # A window starting exactly where hour 3 starts doesn't reach back into hour 2
+    assert counts.total(HOUR, 4 * HOUR).total_tokens == 11_000
+    assert counts.total(2 * HOUR, 5 * HOUR).total_tokens == 11_000
+
+
+def test_total_skips_buckets_without_usage():
+    counts = make_counts()
+    # Nothing has been recorded since hour 4
+    assert counts.total(HOUR, 10 * HOUR).requests == 0
+    assert counts.total(7 * HOUR, 10 * HOUR).total_tokens == 11_000
+
+
+def test_total_sums_every_field():
+    counts = _BucketedCounts(bucket_seconds=HOUR, retention_buckets=5)
+    counts.add_usage(make_usage(3, 4), now=0)
+    counts.add_usage(make_usage(5, 6), now=10)
+
+    total = counts.total(HOUR, 10)
+    assert (total.prompt_tokens, total.completion_tokens, total.requests) == (8, 10, 2)
+    assert total.total_tokens == 18
+
+
+def test_old_buckets_are_dropped_after_retention():
+    counts = make_counts()
+    counts.add_usage(make_usage(100_000), now=5 * HOUR)
+    assert counts.total(10 * HOUR, 5 * HOUR).total_tokens == 111_110